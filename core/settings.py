@@ -148,6 +148,14 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
+# Region-scoped analysis: only the changed part of the board is re-sent to the model.
+# A whole-board refresh runs after this many consecutive region runs.
+ANALYSIS_FULL_REFRESH_EVERY = 10
+# Pixels of context added around the changed area
+ANALYSIS_REGION_PADDING = 32
+# Changed areas larger than this fraction of the board trigger a full refresh
+ANALYSIS_REGION_MAX_FRACTION = 0.5
+
 # Channels in-memory layer for local dev (use Redis in prod)
 CHANNEL_LAYERS = {
     "default": {
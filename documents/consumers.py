@@ -1,11 +1,12 @@
 import json
 import base64
 import uuid
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 from django.core.files.base import ContentFile
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from asgiref.sync import sync_to_async
 from .models import Document
+from .spatial import GridIndex, Rect, get_cached_index, get_index, parse_rect
 from .workers import (
     compute_analysis_for_document,
     compute_interactions_for_document,
@@ -14,6 +15,8 @@ from .workers import (
 
 class DocumentConsumer(AsyncJsonWebsocketConsumer):
     group_name: str
+    # Board rectangle the client is looking at; broadcasts are clipped to it
+    viewport: Optional[Rect] = None
 
     async def connect(self):
         self.doc_id = int(self.scope["url_route"]["kwargs"].get("doc_id"))
@@ -28,6 +31,8 @@ class DocumentConsumer(AsyncJsonWebsocketConsumer):
         event = content.get("event")
         if event == "document.update":
             await self.handle_document_update(content)
+        elif event == "document.viewport":
+            await self.handle_viewport(content)
 
     @sync_to_async
     def _save_document_update(self, data: Dict[str, Any]):
@@ -68,7 +73,9 @@ class DocumentConsumer(AsyncJsonWebsocketConsumer):
             },
         )
         # 3) Compute interactions and notify
-        interactions = await sync_to_async(compute_interactions_for_document)(analysis)
+        interactions = await sync_to_async(compute_interactions_for_document)(
+            analysis, doc
+        )
         await self.channel_layer.group_send(
             self.group_name,
             {
@@ -77,12 +84,61 @@ class DocumentConsumer(AsyncJsonWebsocketConsumer):
             },
         )
 
+    @sync_to_async
+    def _get_analysis_revision(self) -> Optional[str]:
+        return (
+            Document.objects.filter(pk=self.doc_id)
+            .values_list("analysis__revision", flat=True)
+            .get()
+        )
+
+    @sync_to_async
+    def _load_index(self):
+        analysis = Document.objects.values_list("analysis", flat=True).get(pk=self.doc_id)
+        return get_index(self.doc_id, analysis)
+
+    async def handle_viewport(self, content: Dict[str, Any]):
+        # A null/invalid viewport unsubscribes from clipping
+        self.viewport = parse_rect(content.get("viewport"))
+        if self.viewport is None:
+            return
+        # Fires on every pan/zoom: only load the analysis when the cached index is stale
+        revision = await self._get_analysis_revision()
+        index = get_cached_index(self.doc_id, revision) or await self._load_index()
+        await self.send_json(
+            {"event": "document.viewport.items", **index.query(self.viewport)}
+        )
+
     async def document_analysis_done(self, event: Dict[str, Any]):
+        analysis = event["analysis"]
+        if self.viewport is None:
+            await self.send_json({"event": "document.analysis.done", "analysis": analysis})
+            return
+        index = get_cached_index(
+            self.doc_id, analysis.get("revision")
+        ) or await sync_to_async(get_index)(self.doc_id, analysis)
+        clipped = {**analysis, "items": index.items.query(self.viewport)}
+        if "interactions" in analysis:
+            clipped["interactions"] = index.interactions.query(self.viewport)
         await self.send_json(
-            {"event": "document.analysis.done", "analysis": event["analysis"]}
+            {
+                "event": "document.analysis.done",
+                "analysis": clipped,
+                "viewport": list(self.viewport),
+            }
         )
 
     async def document_interactions(self, event: Dict[str, Any]):
+        interactions = event["interactions"]
+        if self.viewport is None:
+            await self.send_json(
+                {"event": "document.interactions", "interactions": interactions}
+            )
+            return
         await self.send_json(
-            {"event": "document.interactions", "interactions": event["interactions"]}
+            {
+                "event": "document.interactions",
+                "interactions": GridIndex(interactions).query(self.viewport),
+                "viewport": list(self.viewport),
+            }
         )
@@ -0,0 +1,213 @@
+"""
+Compare the sync DRF document views with their async-native counterparts.
+
+Requests are driven straight through Django's ASGI handler (no network or daphne in
+the loop), so the numbers isolate the view/ORM path: thread-pool hops, DB access and
+response rendering. Usage:
+
+    python manage.py benchmark_rest --requests 2000 --concurrency 200
+
+Thumbnail uploads are measured with the analysis pipeline replaced by a sleep of
+``--model-latency`` seconds (no OpenAI calls), while detail GETs run alongside them
+to show whether slow uploads stall the other endpoints.
+"""
+
+import asyncio
+import io
+import statistics
+import tempfile
+import time
+from typing import List, Optional, Tuple
+from unittest import mock
+from PIL import Image
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.utils import override_settings
+from django.urls import path
+from documents import views
+from documents.models import Document
+
+
+# Both view sets side by side; installed as ROOT_URLCONF while the benchmark runs
+urlpatterns = [
+    path("sync/documents/", views.DocumentListCreateView.as_view()),
+    path("sync/documents/<int:pk>/", views.DocumentRetrieveUpdateView.as_view()),
+    path(
+        "sync/documents/<int:pk>/thumbnail/",
+        views.DocumentThumbnailUploadView.as_view(),
+    ),
+    path("async/documents/", views.AsyncDocumentListCreateView.as_view()),
+    path("async/documents/<int:pk>/", views.AsyncDocumentRetrieveUpdateView.as_view()),
+    path(
+        "async/documents/<int:pk>/thumbnail/",
+        views.AsyncDocumentThumbnailUploadView.as_view(),
+    ),
+]
+
+
+async def asgi_request(
+    app,
+    path_: str,
+    method: str = "GET",
+    body: bytes = b"",
+    content_type: Optional[str] = None,
+) -> Tuple[int, float]:
+    """Issue one request against the ASGI app; return (status, latency in seconds)."""
+    headers = [(b"host", b"localhost"), (b"content-length", str(len(body)).encode())]
+    if content_type:
+        headers.append((b"content-type", content_type.encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path_,
+        "raw_path": path_.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    sent_body = False
+    disconnect = asyncio.Event()
+    status_code = 0
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    disconnect.set()
+    return status_code, time.perf_counter() - start
+
+
+async def run_load(app, path_: str, total: int, concurrency: int, **request_kwargs):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            status_code, latency = await asgi_request(app, path_, **request_kwargs)
+        if status_code != 200:
+            errors += 1
+        latencies.append(latency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def thumbnail_body() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (256, 256), "white").save(buf, format="PNG")
+    upload = SimpleUploadedFile("bench.png", buf.getvalue(), "image/png")
+    return encode_multipart(BOUNDARY, {"thumbnail": upload})
+
+
+class Command(BaseCommand):
+    help = "Benchmark sync vs async document REST views at high concurrency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, default=200)
+        parser.add_argument("--uploads", type=int, default=50)
+        parser.add_argument(
+            "--model-latency",
+            type=float,
+            default=0.2,
+            help="Seconds the stubbed analysis pipeline sleeps per upload.",
+        )
+
+    def handle(self, *args, **options):
+        created = None
+        document = Document.objects.order_by("-updated_at").first()
+        if document is None:
+            document = created = Document.objects.create(title="Benchmark")
+        try:
+            with override_settings(ROOT_URLCONF=__name__, DEBUG=False):
+                app = get_asgi_application()
+                for label, path_ in [
+                    ("list", "documents/"),
+                    ("detail", f"documents/{document.pk}/"),
+                ]:
+                    for flavour in ("sync", "async"):
+                        self.report(
+                            f"{flavour:5} {label:6}",
+                            asyncio.run(
+                                run_load(
+                                    app,
+                                    f"/{flavour}/{path_}",
+                                    options["requests"],
+                                    options["concurrency"],
+                                )
+                            ),
+                        )
+                self.benchmark_uploads(app, document, options)
+        finally:
+            if created is not None:
+                created.delete()
+
+    def benchmark_uploads(self, app, document, options) -> None:
+        body = thumbnail_body()
+        latency = options["model_latency"]
+        original = (document.image.name, document.thumbnail.name)
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root
+        ), mock.patch(
+            "documents.views.run_analysis_pipeline", lambda _: time.sleep(latency)
+        ):
+            for flavour in ("sync", "async"):
+
+                async def mixed():
+                    return await asyncio.gather(
+                        run_load(
+                            app,
+                            f"/{flavour}/documents/{document.pk}/thumbnail/",
+                            options["uploads"],
+                            options["concurrency"],
+                            method="PATCH",
+                            body=body,
+                            content_type=MULTIPART_CONTENT,
+                        ),
+                        run_load(
+                            app,
+                            f"/{flavour}/documents/{document.pk}/",
+                            options["uploads"],
+                            options["concurrency"],
+                        ),
+                    )
+
+                uploads, details = asyncio.run(mixed())
+                self.report(f"{flavour:5} upload", uploads)
+                self.report(f"{flavour:5} +get  ", details)
+        # Point the document back at its real files
+        Document.objects.filter(pk=document.pk).update(
+            image=original[0], thumbnail=original[1]
+        )
+
+    def report(self, label: str, result) -> None:
+        elapsed, latencies, errors = result
+        latencies.sort()
+        ms = [1000 * v for v in latencies]
+        self.stdout.write(
+            f"{label}  {len(ms) / elapsed:8.1f} req/s  "
+            f"p50 {statistics.median(ms):7.1f} ms  "
+            f"p99 {ms[int(0.99 * (len(ms) - 1))]:7.1f} ms  "
+            f"errors {errors}"
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0002_document_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='analysis_state',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
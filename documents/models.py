@@ -12,6 +12,8 @@ class Document(models.Model):
     thumbnail = models.ImageField(upload_to="thumbnails/", null=True, blank=True)
     # Most recent AI analysis: description and element boxes
     analysis = models.JSONField(default=dict, blank=True)
+    # Server-side bookkeeping for region-scoped analysis; never sent to clients
+    analysis_state = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
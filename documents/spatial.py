@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+
+Rect = Tuple[float, float, float, float]
+
+# Side of a grid cell, in board pixels. Items are bucketed into every cell their
+# bbox overlaps, so this trades bucket size against per-item fan-out.
+GRID_CELL_SIZE = 256
+# Boxes spanning more cells than this skip the grid and are tested on every query
+MAX_CELLS_PER_BOX = 64
+# Indexes kept per process; the least recently used document is evicted first
+MAX_CACHED_INDEXES = 256
+
+
+def parse_rect(values: Sequence[Any]) -> Optional[Rect]:
+    """Normalize an [x1,y1,x2,y2] sequence; return None if it isn't one."""
+    try:
+        x1, y1, x2, y2 = (float(v) for v in values)
+    except (TypeError, ValueError):
+        return None
+    if not all(np.isfinite([x1, y1, x2, y2])):
+        return None
+    return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+
+class GridIndex:
+    """Uniform grid over a set of bboxes, backed by an (N, 4) float array."""
+
+    def __init__(self, entries: List[Dict[str, Any]], cell_size: int = GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.entries: List[Dict[str, Any]] = []
+        boxes: List[Rect] = []
+        for entry in entries:
+            rect = parse_rect(entry.get("bbox")) if isinstance(entry, dict) else None
+            if rect is None:
+                # Entries we can't place on the board are never returned by queries
+                continue
+            self.entries.append(entry)
+            boxes.append(rect)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        self.oversized: List[int] = []
+        if not len(self.boxes):
+            return
+        spans = np.floor_divide(self.boxes, cell_size).astype(np.int64)
+        for i, (cx1, cy1, cx2, cy2) in enumerate(spans.tolist()):
+            if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > MAX_CELLS_PER_BOX:
+                self.oversized.append(i)
+                continue
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def query(self, rect: Rect) -> List[Dict[str, Any]]:
+        """Return the entries whose bbox intersects ``rect``, in insertion order."""
+        if not self.entries:
+            return []
+        x1, y1, x2, y2 = rect
+        cx1, cy1, cx2, cy2 = (int(v // self.cell_size) for v in rect)
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) >= len(self.cells):
+            # Viewport covers more cells than are populated: scan the whole array
+            candidates = np.arange(len(self.boxes))
+        else:
+            found = set(self.oversized)
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    found.update(self.cells.get((cx, cy), ()))
+            if not found:
+                return []
+            candidates = np.fromiter(sorted(found), dtype=np.int64, count=len(found))
+        b = self.boxes[candidates]
+        hit = (b[:, 0] <= x2) & (b[:, 2] >= x1) & (b[:, 1] <= y2) & (b[:, 3] >= y1)
+        return [self.entries[i] for i in candidates[hit].tolist()]
+
+
+class AnalysisIndex:
+    """Spatial indexes over the items and interactions of one stored analysis."""
+
+    def __init__(self, analysis: Dict[str, Any]):
+        analysis = analysis or {}
+        self.revision = analysis.get("revision")
+        self.items = GridIndex(list(analysis.get("items") or []))
+        self.interactions = GridIndex(list(analysis.get("interactions") or []))
+
+    def query(self, rect: Rect) -> Dict[str, Any]:
+        return {
+            "viewport": list(rect),
+            "items": self.items.query(rect),
+            "interactions": self.interactions.query(rect),
+        }
+
+
+# Per-process LRU cache: doc id -> index of the analysis revision it was built from
+_indexes: "OrderedDict[int, AnalysisIndex]" = OrderedDict()
+# Touched from the event loop and from sync_to_async worker threads
+_indexes_lock = threading.Lock()
+
+
+def _remember(doc_id: int, index: AnalysisIndex) -> AnalysisIndex:
+    with _indexes_lock:
+        _indexes[doc_id] = index
+        _indexes.move_to_end(doc_id)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def get_cached_index(doc_id: int, revision: Optional[str]) -> Optional[AnalysisIndex]:
+    """Return the cached index only if it was built from ``revision``."""
+    with _indexes_lock:
+        index = _indexes.get(doc_id)
+        if index is None or revision is None or index.revision != revision:
+            return None
+        _indexes.move_to_end(doc_id)
+    return index
+
+
+def get_index(doc_id: int, analysis: Dict[str, Any]) -> AnalysisIndex:
+    """Return the cached index for a document, rebuilding it if the analysis changed."""
+    index = get_cached_index(doc_id, (analysis or {}).get("revision"))
+    return index or _remember(doc_id, AnalysisIndex(analysis))
+
+
+def build_index_for_document(document) -> AnalysisIndex:
+    return _remember(document.id, AnalysisIndex(document.analysis))
+
+
+def query_viewport(document, rect: Rect) -> Dict[str, Any]:
+    return get_index(document.id, document.analysis).query(rect)
@@ -1,3 +1,509 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+from collections import OrderedDict
+from unittest import mock
+from PIL import Image
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.urls import reverse
+from rest_framework.test import APIClient
+from . import spatial, views
+from .models import Document
+from .routing import websocket_urlpatterns
+from .spatial import GridIndex, get_cached_index, get_index, parse_rect
+from .workers import (
+    compute_analysis_for_document,
+    compute_changed_region,
+    compute_interactions_for_document,
+    expand_region,
+    merge_region_analysis,
+    plan_analysis_region,
+    save_analysis_for_document,
+    translate_box,
+)
 
-# Create your tests here.
+
+class ParseRectTests(SimpleTestCase):
+    def test_normalizes_corner_order(self):
+        self.assertEqual(parse_rect([10, 20, 0, 5]), (0.0, 5.0, 10.0, 20.0))
+
+    def test_rejects_malformed_values(self):
+        for values in (None, [1, 2, 3], ["a", 0, 1, 1], [0, 0, float("inf"), 1]):
+            with self.subTest(values=values):
+                self.assertIsNone(parse_rect(values))
+
+
+class GridIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.items = [
+            {"id": "a", "bbox": [0, 0, 10, 10]},
+            {"id": "b", "bbox": [1000, 1000, 1010, 1010]},
+            {"id": "c", "bbox": [5000, 0, 5010, 10]},
+            {"id": "no-bbox"},
+        ]
+
+    def ids(self, entries):
+        return [e["id"] for e in entries]
+
+    def test_query_returns_intersecting_entries_in_order(self):
+        index = GridIndex(self.items, cell_size=100)
+        self.assertEqual(self.ids(index.query((5, 5, 1005, 1005))), ["a", "b"])
+        self.assertEqual(self.ids(index.query((20, 20, 30, 30))), [])
+        # Touching edges count as intersecting
+        self.assertEqual(self.ids(index.query((10, 10, 20, 20))), ["a"])
+
+    def test_entries_without_bbox_are_not_indexed(self):
+        index = GridIndex(self.items, cell_size=100)
+        self.assertEqual(len(index), 3)
+        self.assertNotIn("no-bbox", self.ids(index.query((-1e9, -1e9, 1e9, 1e9))))
+
+    def test_full_scan_matches_grid_lookup(self):
+        index = GridIndex(self.items, cell_size=100)
+        # Covers far more cells than are populated, so the whole array is scanned
+        self.assertEqual(self.ids(index.query((0, 0, 6000, 6000))), ["a", "b", "c"])
+
+    def test_oversized_boxes_are_always_candidates(self):
+        items = self.items + [{"id": "big", "bbox": [0, 0, 100000, 100000]}]
+        index = GridIndex(items, cell_size=100)
+        self.assertEqual(index.oversized, [3])
+        self.assertEqual(self.ids(index.query((2000, 2000, 2010, 2010))), ["big"])
+        self.assertEqual(self.ids(index.query((0, 0, 1, 1))), ["a", "big"])
+
+
+class IndexCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(spatial, "_indexes", OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(spatial, "MAX_CACHED_INDEXES", 2)
+    def test_least_recently_used_index_is_evicted(self):
+        for doc_id in (1, 2):
+            get_index(doc_id, {"revision": f"r{doc_id}", "items": []})
+        self.assertIsNotNone(get_cached_index(1, "r1"))  # 1 is now most recent
+        get_index(3, {"revision": "r3", "items": []})
+        self.assertIsNone(get_cached_index(2, "r2"))
+        self.assertIsNotNone(get_cached_index(1, "r1"))
+        self.assertIsNotNone(get_cached_index(3, "r3"))
+
+    def test_new_revision_replaces_cached_index(self):
+        first = get_index(1, {"revision": "r1", "items": []})
+        self.assertIs(get_index(1, {"revision": "r1", "items": []}), first)
+        self.assertIsNot(get_index(1, {"revision": "r2", "items": []}), first)
+        self.assertIsNone(get_cached_index(1, "r1"))
+
+
+class ViewportTests(TestCase):
+    def setUp(self):
+        self.document = Document.objects.create()
+        save_analysis_for_document(
+            self.document,
+            {
+                "summary": "s",
+                "items": [
+                    {"id": "near", "bbox": [0, 0, 10, 10]},
+                    {"id": "far", "bbox": [1000, 1000, 1010, 1010]},
+                ],
+                "interactions": [
+                    {"type": "hint", "label": "near", "bbox": [5, 5, 8, 8]},
+                    {"type": "hint", "label": "far", "bbox": [900, 900, 950, 950]},
+                ],
+            },
+        )
+        self.url = reverse("document-viewport", args=[self.document.pk])
+
+    def test_endpoint_returns_only_visible_items_and_interactions(self):
+        response = APIClient().get(self.url, {"x1": 0, "y1": 0, "x2": 50, "y2": 50})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["viewport"], [0, 0, 50, 50])
+        self.assertEqual([i["id"] for i in body["items"]], ["near"])
+        self.assertEqual([i["label"] for i in body["interactions"]], ["near"])
+
+    def test_endpoint_rejects_bad_rectangles(self):
+        for params in ({}, {"x1": 0, "y1": 0, "x2": 50}, {"x1": "a", "y1": 0, "x2": 1, "y2": 1}):
+            with self.subTest(params=params):
+                response = APIClient().get(self.url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("detail", response.json())
+
+    def test_endpoint_404s_for_missing_document(self):
+        response = APIClient().get(
+            reverse("document-viewport", args=[0]), {"x1": 0, "y1": 0, "x2": 1, "y2": 1}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    async def test_websocket_viewport_clips_items_and_broadcasts(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/documents/{self.document.pk}/"
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            await communicator.send_json_to(
+                {"event": "document.viewport", "viewport": [50, 50, 0, 0]}
+            )
+            reply = await communicator.receive_json_from()
+            self.assertEqual(reply["event"], "document.viewport.items")
+            self.assertEqual(reply["viewport"], [0, 0, 50, 50])
+            self.assertEqual([i["id"] for i in reply["items"]], ["near"])
+
+            analysis = (await sync_to_async(Document.objects.get)(pk=self.document.pk)).analysis
+            await get_channel_layer().group_send(
+                f"document_{self.document.pk}",
+                {"type": "document.analysis.done", "analysis": analysis},
+            )
+            event = await communicator.receive_json_from()
+            self.assertEqual(event["event"], "document.analysis.done")
+            self.assertEqual(event["viewport"], [0, 0, 50, 50])
+            self.assertEqual([i["id"] for i in event["analysis"]["items"]], ["near"])
+            self.assertEqual(
+                [i["label"] for i in event["analysis"]["interactions"]], ["near"]
+            )
+            self.assertEqual(event["analysis"]["summary"], "s")
+        finally:
+            await communicator.disconnect()
+
+
+class InteractionsPersistenceTests(TestCase):
+    def setUp(self):
+        self.document = Document.objects.create()
+        save_analysis_for_document(
+            self.document, {"summary": "s", "items": [{"id": "a", "bbox": [0, 0, 1, 1]}]}
+        )
+
+    @mock.patch("documents.workers.get_document_interactions")
+    def test_interactions_are_saved_on_the_same_revision(self, get_interactions):
+        interactions = [{"type": "hint", "label": "x", "bbox": [0, 0, 1, 1]}]
+        get_interactions.return_value = interactions
+        updated_at = Document.objects.get(pk=self.document.pk).updated_at
+        compute_interactions_for_document(self.document.analysis, self.document)
+        stored = Document.objects.get(pk=self.document.pk)
+        self.assertEqual(stored.analysis["interactions"], interactions)
+        self.assertEqual(stored.analysis["summary"], "s")
+        self.assertEqual(stored.updated_at, updated_at)
+        index = get_cached_index(stored.pk, stored.analysis["revision"])
+        self.assertEqual(index.interactions.query((0, 0, 1, 1)), interactions)
+
+    @mock.patch("documents.workers.get_document_interactions")
+    def test_stale_interactions_do_not_overwrite_newer_analysis(self, get_interactions):
+        get_interactions.return_value = [{"type": "hint", "label": "x", "bbox": [0, 0, 1, 1]}]
+        stale = dict(self.document.analysis)
+        save_analysis_for_document(self.document, {"summary": "newer", "items": []})
+        compute_interactions_for_document(stale, self.document)
+        stored = Document.objects.get(pk=self.document.pk).analysis
+        self.assertEqual(stored["summary"], "newer")
+        self.assertNotIn("interactions", stored)
+
+
+class RegionAnalysisTests(SimpleTestCase):
+    def test_changed_region_is_padded_and_clamped(self):
+        before = Image.new("RGB", (100, 100), "white")
+        after = before.copy()
+        after.paste((0, 0, 0), (10, 20, 16, 26))
+        self.assertEqual(compute_changed_region(before, after, padding=2), (8, 18, 18, 28))
+        self.assertEqual(compute_changed_region(before, after, padding=50), (0, 0, 66, 76))
+
+    def test_identical_images_have_no_changed_region(self):
+        image = Image.new("RGB", (10, 10), "white")
+        self.assertIsNone(compute_changed_region(image, image.copy()))
+
+    def test_expand_region_covers_touched_items(self):
+        items = [
+            {"bbox": [5, 5, 50, 20]},
+            {"bbox": [45, 15, 80, 30]},
+            {"bbox": [90, 90, 120, 95]},
+        ]
+        self.assertEqual(expand_region((0, 0, 10, 10), items, (100, 100)), (0, 0, 80, 30))
+        # Items running off the image are clamped to its bounds
+        self.assertEqual(expand_region((85, 85, 92, 92), items, (100, 100)), (85, 85, 100, 95))
+
+    def test_translate_box(self):
+        self.assertEqual(translate_box([10, 20, 30, 40], -10, -20), [0, 0, 20, 20])
+        self.assertIsNone(translate_box("nope", 0, 0))
+
+    def test_merge_replaces_region_items_and_dedupes_ids(self):
+        previous = {
+            "summary": "old",
+            "items": [
+                {"id": "a", "bbox": [25, 25, 30, 30]},
+                {"id": "b", "bbox": [100, 100, 110, 110]},
+            ],
+        }
+        region_analysis = {
+            "items": [
+                {"id": "a", "bbox": [0, 0, 5, 5]},
+                {"id": "b", "bbox": [10, 10, 15, 15]},
+            ]
+        }
+        merged = merge_region_analysis(previous, region_analysis, (20, 20, 60, 60))
+        self.assertEqual(merged["summary"], "old")
+        self.assertEqual(
+            merged["items"],
+            [
+                {"id": "b", "bbox": [100, 100, 110, 110]},
+                {"id": "a", "bbox": [20, 20, 25, 25]},
+                {"id": "b-2", "bbox": [30, 30, 35, 35]},
+            ],
+        )
+
+
+class RegionAnalysisPersistenceTests(TestCase):
+    def setUp(self):
+        self.analysis = {
+            "summary": "s",
+            "items": [{"id": "a", "bbox": [0, 0, 10, 10]}],
+            "interactions": [{"type": "hint", "label": "x", "bbox": [0, 0, 1, 1]}],
+            "revision": "r1",
+        }
+        self.state = {"image": "images/old.png", "region_runs": 3}
+        self.document = Document.objects.create(
+            analysis=self.analysis, analysis_state=self.state
+        )
+
+    @mock.patch("documents.workers.compute_detected_boxes_for_document", return_value=[])
+    @mock.patch("documents.workers.get_document_analysis", return_value=None)
+    def test_failed_model_call_keeps_previous_analysis(self, get_analysis, _):
+        for plan in (("region", (0, 0, 20, 20)), ("full", None)):
+            with self.subTest(mode=plan[0]), mock.patch(
+                "documents.workers.plan_analysis_region", return_value=plan
+            ):
+                self.assertEqual(compute_analysis_for_document(self.document), self.analysis)
+                stored = Document.objects.get(pk=self.document.pk)
+                self.assertEqual(stored.analysis, self.analysis)
+                self.assertEqual(stored.analysis_state, self.state)
+
+    @mock.patch("documents.workers.get_document_interactions")
+    def test_unchanged_analysis_reuses_interactions(self, get_interactions):
+        with mock.patch(
+            "documents.workers.plan_analysis_region", return_value=("unchanged", None)
+        ):
+            analysis = compute_analysis_for_document(self.document)
+        interactions = compute_interactions_for_document(analysis, self.document)
+        self.assertEqual(interactions, self.analysis["interactions"])
+        get_interactions.assert_not_called()
+        self.assertEqual(Document.objects.get(pk=self.document.pk).analysis, self.analysis)
+
+
+@override_settings(
+    ANALYSIS_FULL_REFRESH_EVERY=10,
+    ANALYSIS_REGION_PADDING=32,
+    ANALYSIS_REGION_MAX_FRACTION=0.5,
+)
+class PlanAnalysisRegionTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.document = Document.objects.create()
+        self.previous = {"summary": "s", "items": [{"id": "a", "bbox": [130, 130, 200, 150]}]}
+        self.baseline = self.store(self.board())
+
+    def board(self, size=(400, 400), patch=None):
+        image = Image.new("RGB", size, "white")
+        if patch:
+            image.paste((0, 0, 0), patch)
+        return image
+
+    def store(self, image) -> str:
+        """Save ``image`` as the document's current image and return its name."""
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        self.document.image.save("board.png", ContentFile(buf.getvalue()))
+        return self.document.image.name
+
+    def plan(self, **state):
+        state = {"image": self.baseline, "region_runs": 0, **state}
+        return plan_analysis_region(self.document.image, self.previous, state)
+
+    def test_same_file_is_unchanged(self):
+        self.assertEqual(self.plan(), ("unchanged", None))
+
+    def test_identical_pixels_are_unchanged(self):
+        self.store(self.board())
+        self.assertEqual(self.plan(), ("unchanged", None))
+
+    def test_small_change_is_a_region_grown_to_touched_items(self):
+        self.store(self.board(patch=(100, 100, 110, 110)))
+        # Changed pixels (100..110) padded by 32, then grown to cover item "a"
+        self.assertEqual(self.plan(), ("region", (68, 68, 200, 150)))
+
+    def test_large_change_is_full(self):
+        self.store(self.board(patch=(0, 0, 300, 300)))
+        self.assertEqual(self.plan(), ("full", None))
+
+    def test_resized_board_is_full(self):
+        self.store(self.board(size=(500, 400), patch=(100, 100, 110, 110)))
+        self.assertEqual(self.plan(), ("full", None))
+
+    def test_missing_previous_image_is_full(self):
+        self.store(self.board(patch=(100, 100, 110, 110)))
+        self.assertEqual(self.plan(image=None), ("full", None))
+        self.assertEqual(self.plan(image="images/gone.png"), ("full", None))
+
+    def test_periodic_full_refresh(self):
+        self.store(self.board(patch=(100, 100, 110, 110)))
+        self.assertEqual(self.plan(region_runs=9)[0], "region")
+        self.assertEqual(self.plan(region_runs=10), ("full", None))
+
+    @mock.patch("documents.workers.compute_detected_boxes_for_document", return_value=[])
+    @mock.patch("documents.workers.get_document_analysis")
+    def test_region_runs_count_up_and_reset_after_full_run(self, get_analysis, _):
+        get_analysis.side_effect = lambda *args: {"summary": "new", "items": []}
+        self.document.analysis = self.previous
+        self.document.analysis_state = {"image": self.baseline, "region_runs": 9}
+        self.document.save()
+
+        changed = self.store(self.board(patch=(100, 100, 110, 110)))
+        compute_analysis_for_document(self.document)
+        state = Document.objects.get(pk=self.document.pk).analysis_state
+        self.assertEqual(state["region_runs"], 10)
+        self.assertEqual(state["image"], changed)
+        self.assertEqual(state["region"], [68, 68, 200, 150])
+
+        changed = self.store(self.board(patch=(120, 120, 125, 125)))
+        compute_analysis_for_document(self.document)
+        state = Document.objects.get(pk=self.document.pk).analysis_state
+        self.assertEqual(state, {"region_runs": 0, "image": changed})
+        # The full run sends the whole image: no region argument
+        self.assertEqual(len(get_analysis.call_args.args), 2)
+
+
+class AsyncViewParityTests(TestCase):
+    """The async REST views must answer exactly like the DRF views they replace."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.document = Document.objects.create(
+            title="Board", data={"elements": []}, analysis={"summary": "s", "items": []}
+        )
+
+    def call(self, view_class, request, **kwargs):
+        response = view_class.as_view()(request, **kwargs)
+        if asyncio.iscoroutine(response):
+
+            async def await_response():
+                return await response
+
+            response = async_to_sync(await_response)()
+        else:
+            response.render()
+        body = json.loads(response.content) if response.content else None
+        return response.status_code, body
+
+    def patch_json(self, body):
+        return self.factory.patch("/", body, content_type="application/json")
+
+    def assertParity(self, sync_view, async_view, make_request, **kwargs):
+        sync_result = self.call(sync_view, make_request(), **kwargs)
+        async_result = self.call(async_view, make_request(), **kwargs)
+        self.assertEqual(async_result, sync_result)
+        return async_result
+
+    def test_list_and_retrieve(self):
+        self.assertParity(
+            views.DocumentListCreateView,
+            views.AsyncDocumentListCreateView,
+            lambda: self.factory.get("/api/documents/"),
+        )
+        status_code, body = self.assertParity(
+            views.DocumentRetrieveUpdateView,
+            views.AsyncDocumentRetrieveUpdateView,
+            lambda: self.factory.get("/api/documents/1/"),
+            pk=self.document.pk,
+        )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body["title"], "Board")
+
+    def test_create(self):
+        payload = json.dumps({"title": "New", "data": {"elements": [1]}})
+        make_request = lambda: self.factory.post(
+            "/api/documents/", payload, content_type="application/json"
+        )
+        sync_status, sync_body = self.call(views.DocumentListCreateView, make_request())
+        async_status, async_body = self.call(
+            views.AsyncDocumentListCreateView, make_request()
+        )
+        self.assertEqual((async_status, sync_status), (201, 201))
+        for key in ("id", "created_at", "updated_at"):
+            del sync_body[key], async_body[key]
+        self.assertEqual(async_body, sync_body)
+
+    def test_update_errors_and_edge_cases(self):
+        detail = (views.DocumentRetrieveUpdateView, views.AsyncDocumentRetrieveUpdateView)
+        cases = [
+            ("missing", lambda: self.factory.get("/"), {"pk": 0}),
+            ("bad json", lambda: self.patch_json("{"), {}),
+            ("bad media type", lambda: self.factory.patch("/", "x=1", content_type="text/plain"), {}),
+            ("invalid field", lambda: self.patch_json(json.dumps({"title": None})), {}),
+            ("not allowed", lambda: self.factory.delete("/"), {}),
+        ]
+        for name, make_request, kwargs in cases:
+            with self.subTest(name):
+                self.assertParity(*detail, make_request, **{"pk": self.document.pk, **kwargs})
+
+    def test_empty_patch_is_a_no_op(self):
+        sync_status, sync_body = self.call(
+            views.DocumentRetrieveUpdateView, self.factory.patch("/"), pk=self.document.pk
+        )
+        async_status, async_body = self.call(
+            views.AsyncDocumentRetrieveUpdateView, self.factory.patch("/"), pk=self.document.pk
+        )
+        self.assertEqual((async_status, sync_status), (200, 200))
+        del sync_body["updated_at"], async_body["updated_at"]
+        self.assertEqual(async_body, sync_body)
+
+    def test_thumbnail_errors(self):
+        thumbnail = (views.DocumentThumbnailUploadView, views.AsyncDocumentThumbnailUploadView)
+        self.assertParity(*thumbnail, lambda: self.factory.patch("/"), pk=self.document.pk)
+        self.assertParity(*thumbnail, lambda: self.factory.patch("/"), pk=0)
+
+    @mock.patch("documents.views.run_analysis_pipeline")
+    def test_thumbnail_upload_returns_relative_urls(self, _):
+        buf = io.BytesIO()
+        Image.new("RGB", (4, 4), "white").save(buf, format="PNG")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root
+        ):
+            for view_class in (
+                views.DocumentThumbnailUploadView,
+                views.AsyncDocumentThumbnailUploadView,
+            ):
+                with self.subTest(view_class.__name__):
+                    upload = SimpleUploadedFile("t.png", buf.getvalue(), "image/png")
+                    request = self.factory.patch(
+                        "/",
+                        encode_multipart(BOUNDARY, {"thumbnail": upload}),
+                        content_type=MULTIPART_CONTENT,
+                    )
+                    status_code, body = self.call(view_class, request, pk=self.document.pk)
+                    self.assertEqual(status_code, 200)
+                    self.assertTrue(body["thumbnail"].startswith("/media/thumbnails/"))
+                    self.assertTrue(body["image"].startswith("/media/images/"))
+
+    @mock.patch("documents.views.run_analysis_pipeline")
+    def test_thumbnail_upload_through_url(self, run_pipeline):
+        buf = io.BytesIO()
+        Image.new("RGB", (4, 4), "white").save(buf, format="PNG")
+        upload = SimpleUploadedFile("t.png", buf.getvalue(), "image/png")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root
+        ):
+            response = APIClient().patch(
+                reverse("document-thumbnail", args=[self.document.pk]),
+                {"thumbnail": upload},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.json()["thumbnail"].startswith("/media/thumbnails/"))
+        run_pipeline.assert_called_once()
@@ -5,17 +5,22 @@ from . import views
 urlpatterns = [
     path(
         "documents/",
-        views.DocumentListCreateView.as_view(),
+        views.AsyncDocumentListCreateView.as_view(),
         name="document-list-create",
     ),
     path(
         "documents/<int:pk>/",
-        views.DocumentRetrieveUpdateView.as_view(),
+        views.AsyncDocumentRetrieveUpdateView.as_view(),
         name="document-detail",
     ),
     path(
         "documents/<int:pk>/thumbnail/",
-        views.DocumentThumbnailUploadView.as_view(),
+        views.AsyncDocumentThumbnailUploadView.as_view(),
         name="document-thumbnail",
     ),
+    path(
+        "documents/<int:pk>/viewport/",
+        views.DocumentViewportView.as_view(),
+        name="document-viewport",
+    ),
 ]
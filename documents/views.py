@@ -1,10 +1,18 @@
+import io
+import json
 import sys
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.utils.datastructures import MultiValueDict
 from django.shortcuts import get_object_or_404
+from django.views import View
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.renderers import JSONRenderer
 from .models import Document
 from .serializers import DocumentSerializer
+from .spatial import parse_rect, query_viewport
 from .workers import run_analysis_pipeline
 
 
@@ -42,4 +50,173 @@ class DocumentThumbnailUploadView(generics.UpdateAPIView):
         return Response(DocumentSerializer(document).data)
 
 
+class DocumentViewportView(generics.GenericAPIView):
+    """Analysis items and interactions intersecting ?x1=&y1=&x2=&y2=."""
+
+    queryset = Document.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        document = get_object_or_404(Document, pk=kwargs["pk"])
+        rect = parse_rect(
+            [request.query_params.get(k) for k in ("x1", "y1", "x2", "y2")]
+        )
+        if rect is None:
+            return Response(
+                {"detail": "x1, y1, x2 and y2 must be numbers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(query_viewport(document, rect))
+
+
+class AsyncDocumentView(View):
+    """
+    Base for the async-native document endpoints served under ASGI. Responses and
+    error bodies are rendered the same way as the DRF views above.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # No session auth on this API, so skip CSRF like DRF's APIView does
+        view.csrf_exempt = True
+        return view
+
+    def render(self, data, status=status.HTTP_200_OK):
+        return HttpResponse(
+            JSONRenderer().render(data), status=status, content_type="application/json"
+        )
+
+    def serialize(self, document):
+        return DocumentSerializer(document, context={"request": self.request}).data
+
+    def not_found(self):
+        return self.render(
+            {"detail": "No Document matches the given query."},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+    def http_method_not_allowed(self, request, *args, **kwargs):
+        response = self.render(
+            {"detail": f'Method "{request.method}" not allowed.'},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
+        )
+        response["Allow"] = ", ".join(self._allowed_methods())
+
+        async def func():
+            return response
+
+        return func()
+
+    def parse_json(self):
+        """Return (data, None) or (None, error response), mirroring JSONParser."""
+        if not self.request.body:
+            # DRF treats a bodyless request as empty data whatever its content type
+            return {}, None
+        if self.request.content_type != "application/json":
+            return None, self.render(
+                {"detail": f'Unsupported media type "{self.request.content_type}" in request.'},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+        try:
+            return json.loads(self.request.body), None
+        except ValueError as e:
+            return None, self.render(
+                {"detail": f"JSON parse error - {e}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+    def parse_files(self) -> MultiValueDict:
+        """Uploaded files for any method; Django itself only parses them for POST."""
+        if self.request.content_type != "multipart/form-data":
+            return MultiValueDict()
+        _, files = self.request.parse_file_upload(
+            self.request.META, io.BytesIO(self.request.body)
+        )
+        return files
+
+    async def get_document(self, pk):
+        try:
+            return await Document.objects.aget(pk=pk)
+        except Document.DoesNotExist:
+            return None
+
+
+class AsyncDocumentListCreateView(AsyncDocumentView):
+    async def get(self, request, *args, **kwargs):
+        documents = [d async for d in Document.objects.all().order_by("-updated_at")]
+        return self.render(
+            DocumentSerializer(documents, many=True, context={"request": request}).data
+        )
+
+    async def post(self, request, *args, **kwargs):
+        data, error = self.parse_json()
+        if error:
+            return error
+        serializer = DocumentSerializer(data=data, context={"request": request})
+        if not serializer.is_valid():
+            return self.render(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        document = Document(**serializer.validated_data)
+        await document.asave()
+        return self.render(self.serialize(document), status=status.HTTP_201_CREATED)
+
+
+class AsyncDocumentRetrieveUpdateView(AsyncDocumentView):
+    async def get(self, request, *args, **kwargs):
+        document = await self.get_document(kwargs["pk"])
+        if document is None:
+            return self.not_found()
+        return self.render(self.serialize(document))
+
+    async def put(self, request, *args, **kwargs):
+        return await self.update(request, partial=False, **kwargs)
+
+    async def patch(self, request, *args, **kwargs):
+        return await self.update(request, partial=True, **kwargs)
+
+    async def update(self, request, partial: bool, **kwargs):
+        document = await self.get_document(kwargs["pk"])
+        if document is None:
+            return self.not_found()
+        data, error = self.parse_json()
+        if error:
+            return error
+        serializer = DocumentSerializer(
+            document, data=data, partial=partial, context={"request": request}
+        )
+        if not serializer.is_valid():
+            return self.render(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        for attr, value in serializer.validated_data.items():
+            setattr(document, attr, value)
+        await document.asave()
+        return self.render(self.serialize(document))
+
+
+class AsyncDocumentThumbnailUploadView(AsyncDocumentView):
+    async def patch(self, request, *args, **kwargs):
+        document = await self.get_document(kwargs["pk"])
+        if document is None:
+            return self.not_found()
+        # Multipart parsing may spool to temp files, so keep it off the event loop
+        files = await sync_to_async(self.parse_files, thread_sensitive=False)()
+        file_obj = files.get("thumbnail")
+        if not file_obj:
+            return self.render(
+                {"detail": "No thumbnail provided"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        # Storage writes don't touch the DB, so keep them off the ORM's thread
+        await sync_to_async(document.image.save, thread_sensitive=False)(
+            file_obj.name, file_obj, save=False
+        )
+        await sync_to_async(document.thumbnail.save, thread_sensitive=False)(
+            file_obj.name, file_obj, save=False
+        )
+        await document.asave(update_fields=["image", "thumbnail", "updated_at"])
+        try:
+            # Model calls take seconds: keep them off the thread the async ORM shares
+            await sync_to_async(run_analysis_pipeline, thread_sensitive=False)(document)
+        except Exception:
+            pass
+        # No request in context: the sync view returned relative media URLs here
+        return self.render(DocumentSerializer(document).data)
+
+
 # Create your views here.
@@ -1,14 +1,18 @@
 import base64
 import io
 import json
+import math
 import os
-from typing import Dict, Any, List, Tuple
+import uuid
+from typing import Dict, Any, List, Optional, Tuple
 from PIL import Image
 from django.core.files.base import ContentFile
 import numpy as np
 import cv2
 from openai import OpenAI
 from django.conf import settings
+from .models import Document
+from .spatial import GridIndex, Rect, build_index_for_document, parse_rect
 
 
 def preprocess_thumbnail_for_boxes(
@@ -50,18 +54,54 @@ def build_prompt(
     return "\n\n".join(parts)
 
 
-def get_document_analysis(prompt: str, document) -> Dict[str, Any]:
+def build_region_prompt(
+    region: Rect,
+    elements_boxes: List[Tuple[int, int, int, int]],
+    context_items: List[Dict[str, Any]],
+    previous_summary: str,
+) -> str:
+    """Prompt for re-analysing a cropped region. Boxes and items must already be crop-relative."""
+    parts = [
+        "You are given a cropped region of a whiteboard created with Excalidraw.",
+        f"The crop covers {json.dumps(list(region))} of the full board. All coordinates "
+        "below and in your answer are relative to the crop's top-left corner.",
+        "Return a concise JSON with: 'summary' (updated textual description of the WHOLE board), "
+        "and 'items' (array of every item visible in this region).",
+        "Each item: {id, type, text?, bbox:[x1,y1,x2,y2]}.",
+        "Previous summary of the whole board:\n" + (previous_summary or ""),
+        "Items previously found in this region (reuse their ids if they are unchanged):\n"
+        + json.dumps(context_items),
+        "Detected bounding boxes:\n" + json.dumps(elements_boxes),
+        "Respond with ONLY the JSON, no prose.",
+    ]
+    return "\n\n".join(parts)
+
+
+def encode_image_region(image_file, region: Optional[Rect] = None) -> str:
+    """Base64 PNG of the image, cropped to ``region`` if given."""
+    with image_file.open("rb") as f:
+        raw_bytes = f.read()
+    if region is None:
+        return base64.b64encode(raw_bytes).decode()
+    image = Image.open(io.BytesIO(raw_bytes)).crop(tuple(int(v) for v in region))
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def get_document_analysis(
+    prompt: str, image_file, region: Optional[Rect] = None
+) -> Optional[Dict[str, Any]]:
+    """Run the model on the (optionally cropped) board image; None if no usable answer."""
     api_key = settings.OPENAI_API_KEY
     if not api_key:
         print("No OpenAI API key found")
-        return {"summary": "", "items": []}
+        return None
     client = OpenAI(api_key=api_key)
 
-    document.refresh_from_db()
-    image_file = document.image or document.thumbnail
     if not image_file:
-        return {"summary": "", "items": []}
-    image_b64 = base64.b64encode(image_file.file.read()).decode()
+        return None
+    image_b64 = encode_image_region(image_file, region)
 
     resp = client.responses.create(
         model="gpt-5",
@@ -80,10 +120,14 @@ def get_document_analysis(prompt: str, document) -> Dict[str, Any]:
         ],
     )
     try:
-        content = resp.output_text
-        return json.loads(content)
-    except Exception:
-        return {"summary": content if "content" in locals() else "", "items": []}
+        analysis = json.loads(resp.output_text)
+    except Exception as e:
+        print("Error parsing analysis:", e)
+        return None
+    if not isinstance(analysis, dict) or not isinstance(analysis.get("items"), list):
+        print("Malformed analysis:", analysis)
+        return None
+    return analysis
 
 
 INTERACTIONS_JSON_SCHEMA: Dict[str, Any] = {
@@ -182,23 +226,219 @@ def compute_detected_boxes_for_document(document) -> List[Tuple[int, int, int, i
     return []
 
 
+def load_image(storage, name: str) -> Optional[Image.Image]:
+    try:
+        with storage.open(name, "rb") as f:
+            return Image.open(f).convert("RGB")
+    except Exception as e:
+        print("Error loading image:", e)
+        return None
+
+
+def compute_changed_region(
+    previous: Image.Image, current: Image.Image, padding: int = 0
+) -> Optional[Rect]:
+    """Padded bbox of the pixels that differ between two same-sized images, or None."""
+    diff = np.any(np.asarray(previous) != np.asarray(current), axis=2)
+    ys, xs = np.nonzero(diff)
+    if not len(xs):
+        return None
+    width, height = current.size
+    return (
+        max(int(xs.min()) - padding, 0),
+        max(int(ys.min()) - padding, 0),
+        min(int(xs.max()) + 1 + padding, width),
+        min(int(ys.max()) + 1 + padding, height),
+    )
+
+
+def expand_region(
+    region: Rect, items: List[Dict[str, Any]], size: Tuple[int, int]
+) -> Rect:
+    """
+    Grow ``region`` until every item it touches lies inside it (clamped to the image),
+    so no item is sent to the model cut in half.
+    """
+    index = GridIndex(items)
+    width, height = size
+    while True:
+        x1, y1, x2, y2 = region
+        for item in index.query(region):
+            bx1, by1, bx2, by2 = parse_rect(item["bbox"])
+            x1, y1 = min(x1, math.floor(bx1)), min(y1, math.floor(by1))
+            x2, y2 = max(x2, math.ceil(bx2)), max(y2, math.ceil(by2))
+        grown = (max(x1, 0), max(y1, 0), min(x2, width), min(y2, height))
+        if grown == region:
+            return region
+        region = grown
+
+
+def plan_analysis_region(
+    image_file, previous: Dict[str, Any], state: Dict[str, Any]
+) -> Tuple[str, Optional[Rect]]:
+    """
+    Decide how to refresh the analysis. Returns ("full", None), ("unchanged", None)
+    or ("region", rect) where rect is the changed area of the board image.
+    """
+    previous_name = state.get("image")
+    if (
+        not image_file
+        or not previous_name
+        or "items" not in previous
+        or state.get("region_runs", 0) >= settings.ANALYSIS_FULL_REFRESH_EVERY
+    ):
+        return "full", None
+    if previous_name == image_file.name:
+        return "unchanged", None
+    before = load_image(image_file.storage, previous_name)
+    after = load_image(image_file.storage, image_file.name)
+    if before is None or after is None or before.size != after.size:
+        return "full", None
+    region = compute_changed_region(before, after, settings.ANALYSIS_REGION_PADDING)
+    if region is None:
+        return "unchanged", None
+    region = expand_region(region, list(previous.get("items") or []), after.size)
+    width, height = after.size
+    area = (region[2] - region[0]) * (region[3] - region[1])
+    if area > settings.ANALYSIS_REGION_MAX_FRACTION * width * height:
+        return "full", None
+    return "region", region
+
+
+def translate_box(bbox, dx: float, dy: float) -> Optional[List[int]]:
+    rect = parse_rect(bbox)
+    if rect is None:
+        return None
+    x1, y1, x2, y2 = rect
+    return [int(x1 + dx), int(y1 + dy), int(x2 + dx), int(y2 + dy)]
+
+
+def merge_region_analysis(
+    previous: Dict[str, Any], region_analysis: Dict[str, Any], region: Rect
+) -> Dict[str, Any]:
+    """
+    Replace the previous items overlapping ``region`` with the new (crop-relative) ones,
+    translated to board space. New ids clashing with kept items are suffixed.
+    """
+    previous_items = list(previous.get("items") or [])
+    replaced = {id(item) for item in GridIndex(previous_items).query(region)}
+    items = [item for item in previous_items if id(item) not in replaced]
+    used_ids = {item.get("id") for item in items if isinstance(item, dict)}
+    for item in region_analysis.get("items") or []:
+        if not isinstance(item, dict):
+            continue
+        bbox = translate_box(item.get("bbox"), region[0], region[1])
+        item = {**item, "bbox": bbox} if bbox is not None else dict(item)
+        if "id" in item:
+            item_id, n = item["id"], 1
+            while item_id in used_ids:
+                n += 1
+                item_id = f"{item['id']}-{n}"
+            item["id"] = item_id
+            used_ids.add(item_id)
+        items.append(item)
+    return {
+        "summary": region_analysis.get("summary") or previous.get("summary", ""),
+        "items": items,
+    }
+
+
 def compute_analysis_for_document(document) -> Dict[str, Any]:
-    """Compute and persist analysis for a document and return it."""
+    """
+    Compute and persist analysis for a document and return it. Only the region of the
+    board that changed since the last analysis is sent, unless a full refresh is due.
+    If the model gives no usable answer the previous analysis is kept as is.
+    """
+    document.refresh_from_db()
+    previous = document.analysis or {}
+    state = document.analysis_state or {}
+    # Diff, crop and record this exact file, even if a newer upload lands meanwhile
+    image_file = document.image or document.thumbnail
+    mode, region = plan_analysis_region(image_file, previous, state)
+    if mode == "unchanged":
+        return previous
     detected_boxes = compute_detected_boxes_for_document(document)
-    prompt = build_prompt(detected_boxes, document.data or {})
-    analysis = get_document_analysis(prompt, document)
-    document.analysis = analysis
-    document.save(update_fields=["analysis", "updated_at"])
+    if mode == "region":
+        dx, dy = -region[0], -region[1]
+        context_items = [
+            {**item, "bbox": translate_box(item.get("bbox"), dx, dy)}
+            for item in GridIndex(list(previous.get("items") or [])).query(region)
+        ]
+        region_boxes = [
+            tuple(translate_box(entry["bbox"], dx, dy))
+            for entry in GridIndex([{"bbox": b} for b in detected_boxes]).query(region)
+        ]
+        prompt = build_region_prompt(
+            region, region_boxes, context_items, previous.get("summary", "")
+        )
+        region_analysis = get_document_analysis(prompt, image_file, region)
+        if region_analysis is None:
+            return previous
+        analysis = merge_region_analysis(previous, region_analysis, region)
+        state = {
+            "region": list(region),
+            "region_runs": state.get("region_runs", 0) + 1,
+        }
+    else:
+        prompt = build_prompt(detected_boxes, document.data or {})
+        analysis = get_document_analysis(prompt, image_file)
+        if analysis is None:
+            return previous
+        # Stored interactions mean "reuse these", so never take them from the model
+        analysis.pop("interactions", None)
+        state = {"region_runs": 0}
+    state["image"] = image_file.name if image_file else None
+    document.analysis_state = state
+    save_analysis_for_document(document, analysis)
     return analysis
 
 
-def compute_interactions_for_document(analysis: Dict[str, Any]) -> List[Dict[str, Any]]:
-    return get_document_interactions(analysis)
+def save_analysis_for_document(document, analysis: Dict[str, Any]) -> None:
+    """Persist analysis under a fresh revision and rebuild its spatial index."""
+    analysis["revision"] = uuid.uuid4().hex
+    document.analysis = analysis
+    document.save(update_fields=["analysis", "analysis_state", "updated_at"])
+    build_index_for_document(document)
+
+
+def save_interactions_for_document(
+    document, analysis: Dict[str, Any], interactions: List[Dict[str, Any]]
+) -> bool:
+    """
+    Store interactions on the analysis they were computed from. Skipped (returns False)
+    if another analysis was saved meanwhile; ``updated_at`` is left untouched.
+    """
+    revision = analysis.get("revision")
+    if revision is None:
+        return False
+    updated = {**analysis, "interactions": interactions, "revision": uuid.uuid4().hex}
+    saved = Document.objects.filter(
+        pk=document.pk, analysis__revision=revision
+    ).update(analysis=updated)
+    if not saved:
+        return False
+    document.analysis = updated
+    build_index_for_document(document)
+    return True
+
+
+def compute_interactions_for_document(
+    analysis: Dict[str, Any], document=None
+) -> List[Dict[str, Any]]:
+    """
+    Compute interactions; if a document is given, store them on its analysis. An
+    analysis that already carries interactions (i.e. was left unchanged) reuses them.
+    """
+    if document is not None and "interactions" in analysis:
+        return analysis["interactions"]
+    interactions = get_document_interactions(analysis)
+    if document is not None:
+        save_interactions_for_document(document, analysis, interactions)
+    return interactions
 
 
 def run_analysis_pipeline(document) -> None:
     """Backward-compatible wrapper. Computes analysis then interactions. Left in place for REST path."""
     analysis = compute_analysis_for_document(document)
-    interactions = get_document_interactions(analysis)
-    # For now we don't persist interactions on the model; they're ephemeral
+    interactions = compute_interactions_for_document(analysis, document)
     print("Interactions:", interactions)